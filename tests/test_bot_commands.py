@@ -0,0 +1,206 @@
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+
+from vetting_bot.bot_commands import Command
+from vetting_bot.storage import Storage
+
+VETTING_ROOM_ID = "!vetting:example.com"
+NEW_ROOM_ID = "!new:example.com"
+BOT_USER_ID = "@bot:example.com"
+
+
+class CommandTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        # Give commands some Mock'd objects to use
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_storage = Mock(spec=Storage)
+
+        # We don't spec config, as it doesn't currently have well defined attributes
+        self.fake_config = Mock()
+
+        self.fake_room = Mock(spec=nio.MatrixRoom)
+        self.fake_room.room_id = "!abcdefg:example.com"
+
+        self.fake_event = Mock(spec=nio.RoomMessageText)
+        self.fake_event.sender = "@some_other_fake_user:example.com"
+
+    async def _process(self, command: str) -> AsyncMock:
+        """Processes a command and returns the mock used to send text replies"""
+        fake_send_text = AsyncMock()
+        with patch("vetting_bot.bot_commands.send_text_to_room", fake_send_text):
+            await Command(
+                self.fake_client,
+                self.fake_storage,
+                self.fake_config,
+                command,
+                self.fake_room,
+                self.fake_event,
+            ).process()
+
+        return fake_send_text
+
+    async def test_unknown_command(self):
+        """Tests that commands are matched on their whole name, not a prefix"""
+        fake_send_text = await self._process("starter x")
+
+        fake_send_text.assert_awaited_once()
+        self.assertIn("Unknown command 'starter x'", fake_send_text.call_args.args[2])
+
+        # Nothing should have been looked up for the 'start' command
+        self.fake_storage.get_vetting_room_id.assert_not_called()
+
+    async def test_echo(self):
+        """Tests that echo repeats its arguments with their original spacing"""
+        fake_send_text = await self._process("echo  a  b")
+
+        fake_send_text.assert_awaited_once_with(
+            self.fake_client, "!abcdefg:example.com", "a  b"
+        )
+
+    def _make_vetting_room(self, members, users_default=0) -> nio.MatrixRoom:
+        """Creates the vetting room, with the given members mapped to their power
+        level (or None to use the default level)"""
+        room = nio.MatrixRoom(VETTING_ROOM_ID, BOT_USER_ID)
+        room.power_levels.defaults.users_default = users_default
+        for user_id, level in members.items():
+            if level is not None:
+                room.power_levels.users[user_id] = level
+            room.add_member(user_id, None, None)
+
+        return room
+
+    async def _start_vetting(self, room: nio.MatrixRoom):
+        """Runs the start command for @vetted:example.com in the given room"""
+        self.fake_room = room
+        self.fake_event.sender = "@sender:example.com"
+
+        self.fake_client.user_id = BOT_USER_ID
+        self.fake_client.server = "example.com"
+        self.fake_client.room_create = AsyncMock(
+            return_value=nio.RoomCreateResponse(NEW_ROOM_ID)
+        )
+        self.fake_client.room_put_state = AsyncMock(
+            return_value=nio.RoomPutStateResponse("$space_child", NEW_ROOM_ID)
+        )
+        self.fake_client.room_invite = AsyncMock(return_value=nio.RoomInviteResponse())
+
+        self.fake_config.vetting_room_id = VETTING_ROOM_ID
+        self.fake_storage.get_vetting_room_id.return_value = None
+
+        await self._process("start @vetted:example.com")
+
+        self.fake_storage.add_vetting.assert_called_once()
+
+    def _invited(self):
+        """Returns the users invited when creating the room, and the users invited
+        afterwards"""
+        created_with = self.fake_client.room_create.call_args.kwargs["invite"]
+        invited_after = [
+            call.args for call in self.fake_client.room_invite.call_args_list
+        ]
+        return created_with, invited_after
+
+    async def test_start_vetting_invite_batches(self):
+        """Tests that large vetting groups are invited in batches"""
+        self.fake_config.power_level_invite = 50
+        self.fake_config.initial_invite_batch = 1
+
+        await self._start_vetting(
+            self._make_vetting_room(
+                {
+                    BOT_USER_ID: 100,
+                    "@mod1:example.com": 50,
+                    "@mod2:example.com": 50,
+                    "@mod3:example.com": 50,
+                    "@sender:example.com": None,
+                }
+            )
+        )
+
+        # The vetted user and the sender are always invited when creating the room,
+        # along with the first batch of other invitees. The bot never invites itself.
+        created_with, invited_after = self._invited()
+        self.assertEqual(
+            created_with,
+            ["@sender:example.com", "@vetted:example.com", "@mod1:example.com"],
+        )
+        self.assertCountEqual(
+            invited_after,
+            [(NEW_ROOM_ID, "@mod2:example.com"), (NEW_ROOM_ID, "@mod3:example.com")],
+        )
+
+    async def test_start_vetting_empty_invite_batch(self):
+        """Tests that the vetted user and the sender are invited when creating the
+        room, even if the first batch is empty"""
+        self.fake_config.power_level_invite = 50
+        self.fake_config.initial_invite_batch = 0
+
+        await self._start_vetting(
+            self._make_vetting_room({BOT_USER_ID: 100, "@mod1:example.com": 50})
+        )
+
+        created_with, invited_after = self._invited()
+        self.assertEqual(created_with, ["@sender:example.com", "@vetted:example.com"])
+        self.assertEqual(invited_after, [(NEW_ROOM_ID, "@mod1:example.com")])
+
+    async def test_start_vetting_invitees_from_power_levels(self):
+        """Tests that invitees are picked from the power levels when the required
+        power level is above the default, leaving out users that aren't members"""
+        self.fake_config.power_level_invite = 50
+        self.fake_config.initial_invite_batch = 50
+
+        room = self._make_vetting_room(
+            {
+                BOT_USER_ID: 100,
+                "@mod1:example.com": 50,
+                "@helper:example.com": 10,
+                "@member:example.com": None,
+            }
+        )
+        # A moderator that has left the room, but is still in the power levels
+        room.power_levels.users["@gone:example.com"] = 50
+
+        await self._start_vetting(room)
+
+        created_with, invited_after = self._invited()
+        self.assertEqual(
+            created_with,
+            ["@sender:example.com", "@vetted:example.com", "@mod1:example.com"],
+        )
+        self.assertEqual(invited_after, [])
+
+    async def test_start_vetting_invitees_from_members(self):
+        """Tests that all members are considered when the required power level is not
+        above the default"""
+        self.fake_config.power_level_invite = 10
+        self.fake_config.initial_invite_batch = 50
+
+        room = self._make_vetting_room(
+            {
+                BOT_USER_ID: 100,
+                "@mod1:example.com": 50,
+                "@muted:example.com": 0,
+                "@member:example.com": None,
+            },
+            users_default=10,
+        )
+
+        await self._start_vetting(room)
+
+        created_with, invited_after = self._invited()
+        self.assertEqual(
+            created_with,
+            [
+                "@sender:example.com",
+                "@vetted:example.com",
+                "@member:example.com",
+                "@mod1:example.com",
+            ],
+        )
+        self.assertEqual(invited_after, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
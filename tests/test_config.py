@@ -12,14 +12,14 @@ class ConfigTestCase(unittest.TestCase):
         # Here's our test dictionary. Pretend that this was parsed from a YAML config file.
         test_config_dict = {"a_key": 5, "some_key": {"some_other_key": "some_value"}}
 
-        # We create a fake config using Mock. _get_cfg will attempt to pull from self.config_dict,
-        # so we use a Mock to quickly create a dummy class, and set the 'config_dict' attribute to
-        # our test dictionary.
+        # We create a fake config using Mock. _get_cfg will attempt to pull from the flattened
+        # self._flat, so we use a Mock to quickly create a dummy class, and set the '_flat'
+        # attribute to our flattened test dictionary.
         fake_config = Mock()
-        fake_config.config_dict = test_config_dict
+        fake_config._flat = Config._flatten_config(test_config_dict)
 
-        # Now let's make some calls to Config._get_cfg. We provide 'fake_cfg' as the first argument
-        # as a substitute for 'self'. _get_cfg will then be pulling values from fake_cfg.config_dict.
+        # Now let's make some calls to Config._get_cfg. We provide 'fake_config' as the first argument
+        # as a substitute for 'self'. _get_cfg will then be pulling values from fake_config._flat.
 
         # Test that we can get the value of a top-level key
         self.assertEqual(
@@ -74,6 +74,36 @@ class ConfigTestCase(unittest.TestCase):
             "something",
         )
 
+        # Test that falsy defaults are used rather than treated as missing
+        self.assertEqual(
+            Config._get_cfg(fake_config, ["a_made_up_key"], default=0, required=True),
+            0,
+        )
+
+        # Test that a whole section can be fetched as well as a single option
+        self.assertEqual(
+            Config._get_cfg(fake_config, ["some_key"]),
+            {"some_other_key": "some_value"},
+        )
+
+    def test_convert_types(self):
+        """Test that Config._convert_types converts options to the type in the schema"""
+        fake_config = Mock()
+        fake_config._flat = Config._flatten_config(
+            {"vetting": {"voting_time": "3600", "min_yes_votes": 2}}
+        )
+
+        Config._convert_types(fake_config)
+
+        # Test that strings are converted, and values of the right type are left alone
+        self.assertEqual(fake_config._flat[("vetting", "voting_time")], 3600)
+        self.assertEqual(fake_config._flat[("vetting", "min_yes_votes")], 2)
+
+        # Test that values that can't be converted raise a ConfigError
+        fake_config._flat[("vetting", "max_no_votes")] = "none"
+        with self.assertRaises(ConfigError):
+            Config._convert_types(fake_config)
+
     # TODO: Test creating a test yaml file, passing the path to Config and _parse_config_values is called correctly
 
 
@@ -0,0 +1,76 @@
+import unittest
+
+from vetting_bot.storage import Storage, latest_migration_version
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # Create a fresh, fully migrated in-memory database for each test
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+
+    def test_migrations(self):
+        """Tests that a new database is migrated to the latest version"""
+        self.store.cursor.execute("SELECT version FROM migration_version")
+        self.assertEqual(self.store.cursor.fetchone()[0], latest_migration_version)
+
+        # Check that the index on pending polls was created and is used to find them
+        self.store.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'vetting'"
+        )
+        index_names = [row[0] for row in self.store.cursor.fetchall()]
+        self.assertIn("idx_vetting_pending", index_names)
+
+        self.store.cursor.execute(
+            "EXPLAIN QUERY PLAN SELECT mxid, poll_event_id, voting_start_time "
+            "FROM vetting WHERE voting_start_time IS NOT NULL AND NOT vote_ended"
+        )
+        query_plan = " ".join(row[-1] for row in self.store.cursor.fetchall())
+        self.assertIn("idx_vetting_pending", query_plan)
+
+    def test_vetting(self):
+        """Tests creating a vetting entry and starting a poll for it"""
+        self.assertIsNone(self.store.get_vetting_room_id("@a:example.com"))
+        self.assertIsNone(self.store.get_vetting("@a:example.com"))
+
+        self.store.add_vetting("@a:example.com", "!a:example.com", 100)
+        self.assertEqual(
+            self.store.get_vetting_room_id("@a:example.com"), "!a:example.com"
+        )
+        self.assertEqual(
+            self.store.get_vetting("@a:example.com"), ("!a:example.com", None)
+        )
+
+        # Test that a poll can only be recorded once
+        self.assertTrue(self.store.set_vetting_poll("@a:example.com", "$poll1", 200))
+        self.assertFalse(self.store.set_vetting_poll("@a:example.com", "$poll2", 300))
+        self.assertEqual(
+            self.store.get_vetting("@a:example.com"), ("!a:example.com", "$poll1")
+        )
+
+        # Test that a poll can't be recorded for a user without a vetting entry
+        self.assertFalse(self.store.set_vetting_poll("@b:example.com", "$poll3", 200))
+
+    def test_pending_polls(self):
+        """Tests that only started polls that haven't ended are pending"""
+        self.store.add_vetting("@a:example.com", "!a:example.com", 100)
+        self.store.add_vetting("@b:example.com", "!b:example.com", 100)
+        self.store.add_vetting("@c:example.com", "!c:example.com", 100)
+
+        # @c:example.com has no poll yet, so is never pending
+        self.store.set_vetting_poll("@a:example.com", "$poll_a", 200)
+        self.store.set_vetting_poll("@b:example.com", "$poll_b", 300)
+
+        self.assertCountEqual(
+            self.store.get_pending_polls(),
+            [("@a:example.com", "$poll_a", 200), ("@b:example.com", "$poll_b", 300)],
+        )
+
+        self.store.set_vote_ended("@a:example.com", "$decision")
+
+        self.assertEqual(
+            self.store.get_pending_polls(), [("@b:example.com", "$poll_b", 300)]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+
+from vetting_bot.storage import Storage
+from vetting_bot.timer import Timer
+
+VETTING_ROOM_ID = "!vetting:example.com"
+POLL_EVENT_ID = "$poll"
+
+
+def make_poll_response(event_id, sender, answers, poll_event_id=POLL_EVENT_ID):
+    """Create a poll response event, as returned by room_messages"""
+    return nio.UnknownEvent.from_dict(
+        {
+            "type": "org.matrix.msc3381.poll.response",
+            "event_id": event_id,
+            "sender": sender,
+            "origin_server_ts": 0,
+            "content": {
+                "m.relates_to": {"rel_type": "m.reference", "event_id": poll_event_id},
+                "org.matrix.msc3381.poll.response": {"answers": answers},
+            },
+        }
+    )
+
+
+def make_poll_start():
+    """Create the poll start event, as returned by room_messages"""
+    return nio.UnknownEvent.from_dict(
+        {
+            "type": "org.matrix.msc3381.poll.start",
+            "event_id": POLL_EVENT_ID,
+            "sender": "@fake_user:example.com",
+            "origin_server_ts": 0,
+            "content": {},
+        }
+    )
+
+
+class TimerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        # Create a Timer object and give it some Mock'd objects to use
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.room_send = AsyncMock(
+            return_value=nio.RoomSendResponse("$poll_end", VETTING_ROOM_ID)
+        )
+        self.fake_client.room_messages = AsyncMock()
+
+        self.fake_storage = Mock(spec=Storage)
+
+        # We don't spec config, as it doesn't currently have well defined attributes
+        self.fake_config = Mock()
+        self.fake_config.vetting_room_id = VETTING_ROOM_ID
+        self.fake_config.min_yes_votes = 1
+        self.fake_config.max_no_votes = 0
+
+        self.timer = Timer(self.fake_client, self.fake_storage, self.fake_config)
+
+    async def _end_poll(self, *pages) -> str:
+        """Ends the poll with room_messages returning the given pages of events, newest
+        first, and returns the text announcing the result"""
+        self.fake_client.room_messages.side_effect = [
+            nio.RoomMessagesResponse(VETTING_ROOM_ID, chunk, f"t{i}", f"t{i + 1}")
+            for i, chunk in enumerate(pages)
+        ]
+
+        fake_send_text = AsyncMock(
+            return_value=nio.RoomSendResponse("$decision", VETTING_ROOM_ID)
+        )
+        with patch("vetting_bot.timer.send_text_to_room", fake_send_text), patch(
+            "vetting_bot.timer.react_to_event", AsyncMock()
+        ):
+            await self.timer._end_poll("@vetted:example.com", POLL_EVENT_ID)
+
+        # Check that the end of the vote was stored
+        self.fake_storage.set_vote_ended.assert_called_once_with(
+            "@vetted:example.com", "$decision"
+        )
+
+        return fake_send_text.call_args.args[2]
+
+    async def test_end_poll_spoiled_vote(self):
+        """Tests that a spoiled latest response replaces the sender's earlier vote"""
+        text = await self._end_poll(
+            [
+                make_poll_response("$3", "@a:example.com", ["bogus"]),
+                make_poll_response("$2", "@b:example.com", []),
+                make_poll_response("$1", "@a:example.com", ["yes"]),
+                make_poll_start(),
+            ]
+        )
+
+        self.assertIn("Yes: 0;", text)
+        self.assertIn("No: 0;", text)
+        self.assertIn("Blank: 0;", text)
+        self.assertIn("not inviting", text)
+
+    async def test_end_poll_counts_last_votes(self):
+        """Tests that votes are counted across pages, keeping each sender's latest
+        response and ignoring responses to other polls or from before the poll"""
+        text = await self._end_poll(
+            # Newest page first
+            [
+                make_poll_response("$6", "@a:example.com", ["yes"]),
+                make_poll_response(
+                    "$5", "@c:example.com", ["no"], poll_event_id="$other_poll"
+                ),
+                make_poll_response("$4", "@b:example.com", ["blank"]),
+            ],
+            [
+                # @a:example.com changed their vote from no to yes
+                make_poll_response("$3", "@a:example.com", ["no"]),
+                make_poll_start(),
+                # Anything older than the poll start can't be a vote
+                make_poll_response("$1", "@d:example.com", ["no"]),
+            ],
+        )
+
+        # Check that the second page was requested from where the first one ended
+        self.assertEqual(self.fake_client.room_messages.await_count, 2)
+        self.assertEqual(
+            self.fake_client.room_messages.await_args.kwargs["start"], "t1"
+        )
+
+        self.assertIn("Yes: 1;", text)
+        self.assertIn("No: 0;", text)
+        self.assertIn("Blank: 1;", text)
+        self.assertIn("Confirm inviting this person", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
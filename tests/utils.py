@@ -3,9 +3,27 @@ import asyncio
 from typing import Any, Awaitable
 
 
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Get the current event loop, or set a new one if there is none or it was closed.
+
+    Async test cases unset the current event loop when they finish, so it can't be
+    relied on to exist in tests that run after them.
+    """
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    return loop
+
+
 def run_coroutine(result: Awaitable[Any]) -> Any:
     """Wrapper for asyncio functions to allow them to be run from synchronous functions"""
-    loop = asyncio.get_event_loop()
+    loop = get_event_loop()
     result = loop.run_until_complete(result)
     loop.close()
     return result
@@ -17,6 +35,6 @@ def make_awaitable(result: Any) -> Awaitable[Any]:
     This uses Futures as they can be awaited multiple times so can be returned
     to multiple callers.
     """
-    future = asyncio.Future()  # type: ignore
+    future = get_event_loop().create_future()
     future.set_result(result)
     return future
@@ -1,14 +1,19 @@
+import asyncio
+import functools
 import logging
-import random
 import re
+import secrets
 import time
+from typing import List
 
 from nio import (
     AsyncClient,
     MatrixRoom,
     RoomCreateError,
+    RoomInviteError,
     RoomMessageText,
     RoomPutStateResponse,
+    RoomRedactError,
     RoomSendError,
 )
 
@@ -19,6 +24,27 @@ from vetting_bot.timer import Timer
 
 logger = logging.getLogger(__name__)
 
+# Matrix user ID: @localpart:server_name, where server_name is an IPv4 literal,
+# an IPv6 literal in brackets or a DNS name, optionally followed by a port
+_USER_ID_RE = re.compile(
+    r"@[!-9;-~]*:"
+    r"((\d{1,3}\.){3}\d{1,3}|\[[0-9A-Fa-f:.]{2,45}\]|[0-9A-Za-z.-]{1,255})(:\d{1,5})?"
+)
+
+# Vote poll answers and their plain text fallback
+_POLL_ANSWERS = [
+    {"id": "yes", "org.matrix.msc1767.text": "Yes"},
+    {"id": "no", "org.matrix.msc1767.text": "No"},
+    {"id": "blank", "org.matrix.msc1767.text": "Blank"},
+]
+_POLL_CHOICES_TEXT = "\n1. Yes\n2. No\n3. Blank"
+
+# matrix.to link templates for a room or user, a room joinable via two servers, and
+# an event
+_MATRIX_TO = "https://matrix.to/#/{}"
+_MATRIX_TO_ROOM = "https://matrix.to/#/{room}?via={a}&via={b}"
+_MATRIX_TO_EVENT = "https://matrix.to/#/{room}/{event}?via={via}"
+
 
 class Command:
     def __init__(
@@ -51,42 +77,30 @@ class Command:
         self.command = command
         self.room = room
         self.event = event
-        self.args = self.command.split()[1:]
+        parts = self.command.split(maxsplit=1)
+        self._verb = parts[0] if parts else ""
+        self._raw_args = parts[1] if len(parts) > 1 else ""
+        self.args = self._raw_args.split()
         
         logger.info("Running command `%s` because of %s", command, event.sender)
 
     async def process(self):
         """Process the command"""
-        if self.command.startswith("echo"):
-            await self._echo()
-        elif self.command.startswith("react"):
-            await self._react()
-        elif self.command.startswith("help"):
-            await self._show_help()
-        elif self.command.startswith("start"):
-            await self._start_vetting()
-        elif self.command.startswith("vote"):
-            await self._start_vote()
-        else:
-            await self._unknown_command()
+        handler = self._HANDLERS.get(self._verb, Command._unknown_command)
+        await handler(self)
 
     async def _echo(self):
         """Echo back the command's arguments"""
-        response = " ".join(self.args)
-        await send_text_to_room(self.client, self.room.room_id, response)
+        await send_text_to_room(self.client, self.room.room_id, self._raw_args)
 
     async def _react(self):
         """Make the bot react to the command message"""
-        # React with a start emoji
-        reaction = "⭐"
-        await react_to_event(
-            self.client, self.room.room_id, self.event.event_id, reaction
-        )
-
-        # React with some generic text
-        reaction = "Some text"
-        await react_to_event(
-            self.client, self.room.room_id, self.event.event_id, reaction
+        # React with a star emoji and some generic text
+        await asyncio.gather(
+            react_to_event(self.client, self.room.room_id, self.event.event_id, "⭐"),
+            react_to_event(
+                self.client, self.room.room_id, self.event.event_id, "Some text"
+            ),
         )
 
     async def _show_help(self):
@@ -111,7 +125,8 @@ class Command:
     async def _start_vetting(self):
         """Starts the vetting process"""
         if self.room.room_id != self.config.vetting_room_id:
-            text = f"This command can only be used in https://matrix.to/#/{self.config.vetting_room_id} !"
+            vetting_room_link = _MATRIX_TO.format(self.config.vetting_room_id)
+            text = f"This command can only be used in {vetting_room_link} !"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
         if not self.args:
@@ -129,109 +144,103 @@ class Command:
             await send_text_to_room(self.client, self.room.room_id, text)
             return
 
+        # The localpart can't contain a colon, so this is the full server name
+        _, _, vetted_user_server = vetted_user_id.partition(":")
+
         # Check if vetting room already exists for user
-        self.store.cursor.execute(
-            "SELECT room_id FROM vetting WHERE mxid=?", (vetted_user_id,)
+        existing_room_id = await asyncio.to_thread(
+            self.store.get_vetting_room_id, vetted_user_id
         )
-        row = self.store.cursor.fetchone()
-        if row is not None:
-            logger.warn("Vetting room already exists for %s", vetted_user_id)
-            text = f"A vetting room already exists for this user: https://matrix.to/#/{row[0]}"
+        if existing_room_id is not None:
+            logger.warning("Vetting room already exists for %s", vetted_user_id)
+            existing_room_link = _MATRIX_TO.format(existing_room_id)
+            text = f"A vetting room already exists for this user: {existing_room_link}"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
         
         logger.info("Creating vetting room for %s", vetted_user_id)
 
         # Get members to invite
-        invitees = set([
-            user.user_id
-            for user in self.room.users.values()
-            if user.power_level >= self.config.power_level_invite
-        ])
-        invitees.add(vetted_user_id) # Invite user to vet
-        invitees.add(self.event.sender) # Invite user that sent the command
-        invitees.remove(self.client.user_id)
+        power_levels = self.room.power_levels
+        if self.config.power_level_invite > power_levels.defaults.users_default:
+            # Only users listed in the power levels event can qualify, so there's
+            # no need to look at every member of the room
+            invitees = {
+                user_id
+                for user_id, level in power_levels.users.items()
+                if level >= self.config.power_level_invite
+                and user_id in self.room.users
+            }
+        else:
+            invitees = {
+                user.user_id
+                for user in self.room.users.values()
+                if user.power_level >= self.config.power_level_invite
+            }
+        # Always invite the user to vet and the user that sent the command when
+        # creating the room
+        first_invitees = {vetted_user_id, self.event.sender}
+        first_invitees.discard(self.client.user_id)
+
+        # Invite the first batch of other members when creating the room and the rest
+        # afterwards, to avoid hitting the homeserver's invite rate limit all at once
+        other_invitees = sorted(invitees - first_invitees - {self.client.user_id})
+        batch_size = self.config.initial_invite_batch
+        initial_invitees = sorted(first_invitees) + other_invitees[:batch_size]
+        remaining_invitees = other_invitees[batch_size:]
 
         # Create new room
-        random_string = hex(random.randrange(4096, 65535))[2:].upper()
-        initial_state = [
-            # Enable encryption
-            {
-                "type": "m.room.encryption",
-                "content": {"algorithm": "m.megolm.v1.aes-sha2"},
-                "state_key": "",
-            },
-            # Make room joinable by federation members
-            {
-                "type": "m.room.join_rules",
-                "state_key": "",
-                "content": {
-                    "join_rule": "restricted",
-                    "allow": [
-                        {
-                            "room_id": self.config.main_space_id,
-                            "type": "m.room_membership",
-                        },
-                        {
-                            "room_id": self.config.vetting_space_id,
-                            "type": "m.room_membership",
-                        },
-                    ],
-                },
-            },
-            # Show message history to new members
-            {
-                "type": "m.room.history_visibility",
-                "state_key": "",
-                "content": {"history_visibility": "shared"},
-            },
-        ]
+        random_string = f"{secrets.randbits(16):04X}"
         room_resp = await self.client.room_create(
             name=f"Vetting {random_string}",
-            invite=invitees,
-            initial_state=initial_state,
+            invite=initial_invitees,
+            initial_state=self.config.vetting_initial_state,
         )
 
         if isinstance(room_resp, RoomCreateError):
+            logger.error("Unable to create room: %s", room_resp)
             text = f"Unable to create room: {room_resp}"
             await send_text_to_room(self.client, self.room.room_id, text)
-            logging.error(text, stack_info=True)
             return
 
         # Create new vetting entry
-        self.store.cursor.execute(
-            "INSERT INTO vetting (mxid, room_id, vetting_create_time) VALUES (?, ?, ?)",
-            (vetted_user_id, room_resp.room_id, time.time()),
+        await asyncio.to_thread(
+            self.store.add_vetting, vetted_user_id, room_resp.room_id, time.time()
         )
         
         logger.debug("Adding vetting room to space")
 
-        # Add newly created room to space
+        vetting_room_link = _MATRIX_TO_ROOM.format(
+            room=room_resp.room_id, a=self.client.server, b=vetted_user_server
+        )
+
+        text = f"Created vetting room for {_MATRIX_TO.format(vetted_user_id)}: {vetting_room_link}"
+
+        # Add newly created room to space and announce it at the same time
         space_child_content = {
             "suggested": False,
             "via": [self.client.server],
         }
-        space_resp = await self.client.room_put_state(
-            room_id=self.config.vetting_space_id,
-            event_type="m.space.child",
-            content=space_child_content,
-            state_key=room_resp.room_id,
+        space_resp, _, _ = await asyncio.gather(
+            self.client.room_put_state(
+                room_id=self.config.vetting_space_id,
+                event_type="m.space.child",
+                content=space_child_content,
+                state_key=room_resp.room_id,
+            ),
+            send_text_to_room(self.client, self.room.room_id, text),
+            self._invite_users(room_resp.room_id, remaining_invitees),
         )
         if not isinstance(space_resp, RoomPutStateResponse):
-            logging.error("Failed to add room to space: %s", space_resp, exc_info=True)
+            logger.error("Failed to add room to space: %s", space_resp)
 
-        vetted_user_server = vetted_user_id.split(":", maxsplit=1)[1]
-        vetting_room_link = f"https://matrix.to/#/{room_resp.room_id}?via={self.client.server}&via={vetted_user_server}"
-
-        text = f"Created vetting room for https://matrix.to/#/{vetted_user_id}: {vetting_room_link}"
-        await send_text_to_room(self.client, self.room.room_id, text)
-        
         logger.info("Vetting room set up for %s", vetted_user_id)
 
     async def _start_vote(self):
         """Starts the vote"""
         if self.room.room_id != self.config.vetting_room_id:
-            text = f"This command can only be used in https://matrix.to/#/{self.config.vetting_room_id} !"
+            vetting_room_link = _MATRIX_TO.format(self.config.vetting_room_id)
+            text = f"This command can only be used in {vetting_room_link} !"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
         if not self.args:
@@ -241,46 +250,44 @@ class Command:
 
         vetted_user_id = self.args[0]
 
+        if not validate_user_id(vetted_user_id):
+            text = (
+                "The entered user id is invalid. "
+                f"It should be in the format of `{self.client.user_id}`"
+            )
+            await send_text_to_room(self.client, self.room.room_id, text)
+            return
+
+        # The localpart can't contain a colon, so this is the full server name
+        _, _, vetted_user_server = vetted_user_id.partition(":")
+
         # Check if vetting room exists for user and poll hasn't been started yet
-        self.store.cursor.execute(
-            "SELECT room_id, poll_event_id, room_id FROM vetting WHERE mxid=?",
-            (vetted_user_id,),
-        )
-        row = self.store.cursor.fetchone()
+        row = await asyncio.to_thread(self.store.get_vetting, vetted_user_id)
         if row is None:
             text = "This user hasn't been vetted, can't vote on them!"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
         if row[1] is not None:
-            event_link = f"https://matrix.to/#/{self.config.vetting_room_id}/{row[1]}?via={self.client.server}"
+            event_link = _MATRIX_TO_EVENT.format(
+                room=self.config.vetting_room_id, event=row[1], via=self.client.server
+            )
             text = f"A poll has already been started for this user: {event_link}"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
 
-        vetting_room_id = row[2]
+        vetting_room_id = row[0]
 
         poll_text = f"Accept {vetted_user_id} into the Federation?"
-        choices = ["yes", "no", "blank"]
-        choices_text = "".join(
-            [
-                f"\n{i}. {choice.title()}"
-                for choice, i in zip(choices, range(1, len(choices) + 1))
-            ]
-        )
-        answers = [
-            {"id": choice, "org.matrix.msc1767.text": choice.title()}
-            for choice in choices
-        ]
 
         event_content = {
-            "org.matrix.msc1767.text": f"{poll_text}{choices_text}",
+            "org.matrix.msc1767.text": f"{poll_text}{_POLL_CHOICES_TEXT}",
             "org.matrix.msc3381.poll.start": {
                 "kind": "org.matrix.msc3381.poll.disclosed",
                 "max_selections": 1,
                 "question": {
                     "org.matrix.msc1767.text": poll_text,
                 },
-                "answers": answers,
+                "answers": _POLL_ANSWERS,
             },
         }
 
@@ -291,33 +298,48 @@ class Command:
         )
 
         if isinstance(poll_resp, RoomSendError):
-            logging.error(poll_resp, stack_info=True)
+            logger.error("Failed to send poll: %s", poll_resp)
             text = f"Failed to send poll: {poll_resp}"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
 
         voting_start_time = time.time()
 
-        self.store.cursor.execute(
-            "UPDATE vetting SET poll_event_id = ?, voting_start_time = ? WHERE mxid = ?",
-            (poll_resp.event_id, voting_start_time, vetted_user_id),
+        poll_recorded = await asyncio.to_thread(
+            self.store.set_vetting_poll,
+            vetted_user_id,
+            poll_resp.event_id,
+            voting_start_time,
         )
+        if not poll_recorded:
+            logger.warning("A poll was started concurrently for %s", vetted_user_id)
+
+            # Nothing will ever end the poll we just sent, so remove it again
+            redact_resp = await self.client.room_redact(
+                self.room.room_id,
+                poll_resp.event_id,
+                reason="A poll has already been started for this user",
+            )
+            if isinstance(redact_resp, RoomRedactError):
+                logger.error("Failed to redact duplicate poll: %s", redact_resp)
+
+            text = "A poll has already been started for this user."
+            await send_text_to_room(self.client, self.room.room_id, text)
+            return
 
         timer = Timer(self.client, self.store, self.config)
-        await timer.wait_for_poll_end(
-            vetted_user_id, poll_resp.event_id, voting_start_time
-        )
+        timer.wait_for_poll_end(vetted_user_id, poll_resp.event_id, voting_start_time)
 
         # Send link to vetting room
-        vetted_user_server = vetted_user_id.split(":", maxsplit=1)[1]
-        vetting_room_link = f"https://matrix.to/#/{vetting_room_id}?via={self.client.server}&via={vetted_user_server}"
+        vetting_room_link = _MATRIX_TO_ROOM.format(
+            room=vetting_room_id, a=self.client.server, b=vetted_user_server
+        )
 
         msg_content = {
             "m.relates_to": {"rel_type": "m.thread", "event_id": poll_resp.event_id},
             "msgtype": "m.text",
             "body": f"Vetting room: {vetting_room_link}",
         }
-
         msg_resp = await self.client.room_send(
             self.room.room_id,
             message_type="m.room.message",
@@ -325,11 +347,23 @@ class Command:
         )
 
         if isinstance(msg_resp, RoomSendError):
-            logging.error(msg_resp, stack_info=True)
+            logger.error("Failed to send vetting room link: %s", msg_resp)
             text = f"Failed to send vetting room link: {msg_resp}"
             await send_text_to_room(self.client, self.room.room_id, text)
             return
 
+    async def _invite_users(self, room_id: str, user_ids: List[str]) -> None:
+        """Invite users to a room, with a limited number of invites in flight"""
+        semaphore = asyncio.Semaphore(5)
+
+        async def _invite(user_id: str):
+            async with semaphore:
+                invite_resp = await self.client.room_invite(room_id, user_id)
+            if isinstance(invite_resp, RoomInviteError):
+                logger.warning("Failed to invite %s: %s", user_id, invite_resp)
+
+        await asyncio.gather(*(_invite(user_id) for user_id in user_ids))
+
     async def _unknown_command(self):
         await send_text_to_room(
             self.client,
@@ -337,15 +371,16 @@ class Command:
             f"Unknown command '{self.command}'. Try the 'help' command for more information.",
         )
 
+    # Map of command names to their handlers
+    _HANDLERS = {
+        "echo": _echo,
+        "react": _react,
+        "help": _show_help,
+        "start": _start_vetting,
+        "vote": _start_vote,
+    }
 
-def validate_user_id(user_id):
-    return (
-        re.match(
-            (
-                r"^@[!-9;-~]*:"
-                r"((\d{1,3}\.){3}\d{1,3}|\[[0-9A-Fa-f:.]{2,45}\]|[0-9A-Za-z.-]{1,255})(:\d{1,5})?$"
-            ),
-            user_id,
-        )
-        is not None
-    )
+
+@functools.lru_cache(maxsize=1024)
+def validate_user_id(user_id: str) -> bool:
+    return _USER_ID_RE.fullmatch(user_id) is not None
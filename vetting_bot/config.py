@@ -1,14 +1,34 @@
 import logging
 import os
 import re
+import stat
 import sys
-from typing import Any, List, Optional
+from typing import Any, Dict, Optional, Sequence, Tuple
 
 import coloredlogs
 import yaml
 
 from vetting_bot.errors import ConfigError
 
+# Loose checks for the form of Matrix user and room IDs
+_CONFIG_USER_ID_RE = re.compile(r"@[^:]+:.+")
+_CONFIG_ROOM_ID_RE = re.compile(r"![^:]+:.+")
+
+# Use the libyaml-backed loader if PyYAML was built with it
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Marks a config option that is not set
+_MISSING = object()
+
+# Expected types of config options, converted to once when the config is loaded
+_SCHEMA = {
+    ("vetting", "voting_time"): int,
+    ("vetting", "min_yes_votes"): int,
+    ("vetting", "max_no_votes"): int,
+    ("vetting", "power_level_invite"): int,
+    ("vetting", "initial_invite_batch"): int,
+}
+
 logger = logging.getLogger()
 logging.getLogger("peewee").setLevel(
     logging.INFO
@@ -20,12 +40,21 @@ class Config:
 
     def __init__(self, filepath: str):
         self.filepath = filepath
-        if not os.path.isfile(filepath):
+        try:
+            file_stat = os.stat(filepath)
+        except FileNotFoundError:
             raise ConfigError(f"Config file '{filepath}' does not exist")
+        except OSError as e:
+            raise ConfigError(f"Config file '{filepath}' is not accessible: {e}")
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise ConfigError(f"Config file '{filepath}' is not a file")
 
         # Load in the config file at the given filepath
-        with open(filepath) as file_stream:
-            self.config_dict = yaml.safe_load(file_stream.read())
+        # Let the parser detect the encoding and read the file in chunks itself
+        with open(filepath, "rb") as file_stream:
+            self.config_dict = yaml.load(file_stream, Loader=Loader)
+        self._flat = self._flatten_config(self.config_dict or {})
+        self._convert_types()
 
         # Parse and validate config options
         self._parse_config_values()
@@ -63,10 +92,16 @@ class Config:
         self.store_path = self._get_cfg(["storage", "store_path"], required=True)
 
         # Create the store folder if it doesn't exist
-        if not os.path.isdir(self.store_path):
-            if not os.path.exists(self.store_path):
-                os.mkdir(self.store_path)
-            else:
+        try:
+            store_stat = os.stat(self.store_path)
+        except FileNotFoundError:
+            os.mkdir(self.store_path)
+        except OSError as e:
+            raise ConfigError(
+                f"storage.store_path '{self.store_path}' is not accessible: {e}"
+            )
+        else:
+            if not stat.S_ISDIR(store_stat.st_mode):
                 raise ConfigError(
                     f"storage.store_path '{self.store_path}' is not a directory"
                 )
@@ -76,21 +111,17 @@ class Config:
 
         # Support both SQLite and Postgres backends
         # Determine which one the user intends
-        sqlite_scheme = "sqlite://"
-        postgres_scheme = "postgres://"
-        if database_path.startswith(sqlite_scheme):
-            self.database = {
-                "type": "sqlite",
-                "connection_string": database_path[len(sqlite_scheme) :],
-            }
-        elif database_path.startswith(postgres_scheme):
+        scheme, _, location = database_path.partition("://")
+        if scheme == "sqlite":
+            self.database = {"type": "sqlite", "connection_string": location}
+        elif scheme == "postgres":
             self.database = {"type": "postgres", "connection_string": database_path}
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
-        if not re.match("@.*:.*", self.user_id):
+        if not _CONFIG_USER_ID_RE.match(self.user_id):
             raise ConfigError("matrix.user_id must be in the form @name:domain")
 
         self.user_password = self._get_cfg(["matrix", "user_password"], required=False)
@@ -108,40 +139,117 @@ class Config:
 
         # Vetting setup
         self.main_space_id = self._get_cfg(["vetting", "main_space_id"], required=True)
-        if not re.match("!.*:.*", self.main_space_id):
+        if not _CONFIG_ROOM_ID_RE.match(self.main_space_id):
             raise ConfigError("vetting.main_space_id must be in the form !xxx:domain")
 
         self.vetting_room_id = self._get_cfg(
             ["vetting", "vetting_room_id"], required=True
         )
-        if not re.match("!.*:.*", self.vetting_room_id):
+        if not _CONFIG_ROOM_ID_RE.match(self.vetting_room_id):
             raise ConfigError("vetting.vetting_room_id must be in the form !xxx:domain")
 
         self.vetting_space_id = self._get_cfg(
             ["vetting", "vetting_space_id"], required=True
         )
-        if not re.match("!.*:.*", self.vetting_space_id):
+        if not _CONFIG_ROOM_ID_RE.match(self.vetting_space_id):
             raise ConfigError(
                 "vetting.vetting_space_id must be in the form !xxx:domain"
             )
 
-        self.voting_time = int(self._get_cfg(["vetting", "voting_time"], required=True))
+        # Initial state of every vetting room. Only depends on config, so it's built
+        # once here and passed as-is to each room creation
+        self.vetting_initial_state = [
+            # Enable encryption
+            {
+                "type": "m.room.encryption",
+                "content": {"algorithm": "m.megolm.v1.aes-sha2"},
+                "state_key": "",
+            },
+            # Make room joinable by federation members
+            {
+                "type": "m.room.join_rules",
+                "state_key": "",
+                "content": {
+                    "join_rule": "restricted",
+                    "allow": [
+                        {
+                            "room_id": self.main_space_id,
+                            "type": "m.room_membership",
+                        },
+                        {
+                            "room_id": self.vetting_space_id,
+                            "type": "m.room_membership",
+                        },
+                    ],
+                },
+            },
+            # Show message history to new members
+            {
+                "type": "m.room.history_visibility",
+                "state_key": "",
+                "content": {"history_visibility": "shared"},
+            },
+        ]
 
-        self.min_yes_votes = int(
-            self._get_cfg(["vetting", "min_yes_votes"], required=True)
-        )
-        self.max_no_votes = int(
-            self._get_cfg(["vetting", "max_no_votes"], required=True)
+        self.voting_time = self._get_cfg(["vetting", "voting_time"], required=True)
+
+        self.min_yes_votes = self._get_cfg(["vetting", "min_yes_votes"], required=True)
+        self.max_no_votes = self._get_cfg(["vetting", "max_no_votes"], required=True)
+
+        self.power_level_invite = self._get_cfg(
+            ["vetting", "power_level_invite"], required=True
         )
-        
-        self.power_level_invite = int(
-            self._get_cfg(["vetting", "power_level_invite"], required=True)
+
+        self.initial_invite_batch = self._get_cfg(
+            ["vetting", "initial_invite_batch"], default=50
         )
+        if self.initial_invite_batch < 0:
+            raise ConfigError("vetting.initial_invite_batch must not be negative")
+
+    @staticmethod
+    def _flatten_config(
+        config_dict: Dict[str, Any], prefix: Tuple[str, ...] = ()
+    ) -> Dict[Tuple[str, ...], Any]:
+        """Map the path of every option and section in the config to its value, so
+        that options can be looked up in one step.
+
+        Options set to null are left out, as if they were not set at all.
+        """
+        flat = {}
+        for name, value in config_dict.items():
+            if value is None:
+                continue
+
+            path = prefix + (name,)
+            flat[path] = value
+            if isinstance(value, dict):
+                flat.update(Config._flatten_config(value, path))
+
+        return flat
+
+    def _convert_types(self):
+        """Convert the config options listed in the schema to their expected type
+
+        Raises:
+            ConfigError: If an option can't be converted to its expected type.
+        """
+        for path, option_type in _SCHEMA.items():
+            value = self._flat.get(path, _MISSING)
+            if value is _MISSING or isinstance(value, option_type):
+                continue
+
+            try:
+                self._flat[path] = option_type(value)
+            except (TypeError, ValueError):
+                raise ConfigError(
+                    f"Config option {'.'.join(path)} must be of type "
+                    f"{option_type.__name__}"
+                )
 
     def _get_cfg(
         self,
-        path: List[str],
-        default: Optional[Any] = None,
+        path: Sequence[str],
+        default: Any = _MISSING,
         required: Optional[bool] = True,
     ) -> Any:
         """Get a config option from a path and option name, specifying whether it is
@@ -151,19 +259,17 @@ class Config:
             ConfigError: If required is True and the object is not found (and there is
                 no default value provided), a ConfigError will be raised.
         """
-        # Sift through the the config until we reach our option
-        config = self.config_dict
-        for name in path:
-            config = config.get(name)
-
-            # If at any point we don't get our expected option...
-            if config is None:
-                # Raise an error if it was required
-                if required and not default:
-                    raise ConfigError(f"Config option {'.'.join(path)} is required")
-
-                # or return the default value
-                return default
-
-        # We found the option. Return it.
-        return config
+        key = path if isinstance(path, tuple) else tuple(path)
+        value = self._flat.get(key, _MISSING)
+        if value is not _MISSING:
+            # We found the option. Return it.
+            return value
+
+        # Raise an error if it was required and there's nothing to fall back to
+        if default is _MISSING:
+            if required:
+                raise ConfigError(f"Config option {'.'.join(path)} is required")
+            return None
+
+        # or return the default value
+        return default
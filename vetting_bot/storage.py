@@ -1,6 +1,6 @@
 import logging
 import sqlite3
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 import psycopg2
 
@@ -11,10 +11,29 @@ import psycopg2
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 1
+latest_migration_version = 2
 
 logger = logging.getLogger(__name__)
 
+# Queries run on every vetting command. Kept as constants so the driver's statement
+# cache is hit instead of re-parsing the SQL each time.
+_SELECT_VETTING_ROOM = "SELECT room_id FROM vetting WHERE mxid = ?"
+_SELECT_VETTING = "SELECT room_id, poll_event_id FROM vetting WHERE mxid = ?"
+_INSERT_VETTING = (
+    "INSERT INTO vetting (mxid, room_id, vetting_create_time) VALUES (?, ?, ?)"
+)
+_UPDATE_VETTING_POLL = (
+    "UPDATE vetting SET poll_event_id = ?, voting_start_time = ? "
+    "WHERE mxid = ? AND poll_event_id IS NULL"
+)
+_SELECT_PENDING_POLLS = (
+    "SELECT mxid, poll_event_id, voting_start_time FROM vetting "
+    "WHERE voting_start_time IS NOT NULL AND NOT vote_ended"
+)
+_UPDATE_VOTE_ENDED = (
+    "UPDATE vetting SET vote_ended = TRUE, decision_event_id = ? WHERE mxid = ?"
+)
+
 
 class Storage:
     def __init__(self, database_config: Dict[str, str]):
@@ -54,8 +73,18 @@ class Storage:
     ) -> Any:
         """Creates and returns a connection to the database"""
         if database_type == "sqlite":
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
+            # Initialize a connection to the database, with autocommit on. Queries
+            # may be run from worker threads (see `_query`), so allow that too.
+            conn = sqlite3.connect(
+                connection_string, isolation_level=None, check_same_thread=False
+            )
+
+            # Let reads proceed while a write is in progress, and only fsync at
+            # checkpoints rather than on every commit
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+            return conn
         elif database_type == "postgres":
             conn = psycopg2.connect(connection_string)
 
@@ -123,6 +152,23 @@ class Storage:
 
             logger.info("Database migrated to v1")
 
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            # Index the polls that haven't ended yet, which are looked up on startup
+            self._execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_vetting_pending
+                ON vetting (voting_start_time)
+                WHERE NOT vote_ended
+                """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
     def _execute(self, *args) -> None:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
 
@@ -135,3 +181,100 @@ class Storage:
             self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
         else:
             self.cursor.execute(*args)
+
+    def _query(self, query: str, params: Tuple = ()) -> Any:
+        """Like `_execute`, but runs the query on a new cursor and returns it.
+
+        The shared `self.cursor` keeps state between execute and fetch, so it must not
+        be used by queries that run off the event loop via `asyncio.to_thread`.
+
+        Args:
+            query: The query to run.
+
+            params: The query parameters.
+
+        Returns:
+            The cursor the query was executed on.
+        """
+        if self.db_type == "postgres":
+            query = query.replace("?", "%s")
+
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        return cursor
+
+    def get_vetting_room_id(self, mxid: str) -> Optional[str]:
+        """Get the ID of the vetting room for a user.
+
+        Args:
+            mxid: The user ID of the user being vetted.
+
+        Returns:
+            The room ID, or None if the user has no vetting room.
+        """
+        row = self._query(_SELECT_VETTING_ROOM, (mxid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_vetting(self, mxid: str) -> Optional[Tuple]:
+        """Get the vetting entry for a user.
+
+        Args:
+            mxid: The user ID of the user being vetted.
+
+        Returns:
+            A (room_id, poll_event_id) row, or None if the user has no vetting entry.
+        """
+        return self._query(_SELECT_VETTING, (mxid,)).fetchone()
+
+    def add_vetting(self, mxid: str, room_id: str, vetting_create_time: float) -> None:
+        """Create a vetting entry for a user.
+
+        Args:
+            mxid: The user ID of the user being vetted.
+
+            room_id: The ID of the vetting room.
+
+            vetting_create_time: When the vetting room was created.
+        """
+        self._query(_INSERT_VETTING, (mxid, room_id, vetting_create_time))
+
+    def set_vetting_poll(
+        self, mxid: str, poll_event_id: str, voting_start_time: float
+    ) -> bool:
+        """Record the poll started for a user, unless one has already been recorded.
+
+        The check and the update happen in a single statement, so two concurrent
+        polls for the same user can't both be recorded.
+
+        Args:
+            mxid: The user ID of the user being vetted.
+
+            poll_event_id: The event ID of the poll start event.
+
+            voting_start_time: When the poll was started.
+
+        Returns:
+            Whether the poll was recorded.
+        """
+        cursor = self._query(
+            _UPDATE_VETTING_POLL, (poll_event_id, voting_start_time, mxid)
+        )
+        return cursor.rowcount > 0
+
+    def get_pending_polls(self) -> List[Tuple]:
+        """Get the polls that have been started but haven't ended yet.
+
+        Returns:
+            A list of (mxid, poll_event_id, voting_start_time) rows.
+        """
+        return self._query(_SELECT_PENDING_POLLS).fetchall()
+
+    def set_vote_ended(self, mxid: str, decision_event_id: str) -> None:
+        """Mark the vote for a user as ended.
+
+        Args:
+            mxid: The user ID of the user being vetted.
+
+            decision_event_id: The event ID of the message announcing the decision.
+        """
+        self._query(_UPDATE_VOTE_ENDED, (decision_event_id, mxid))
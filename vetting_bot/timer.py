@@ -16,6 +16,22 @@ from vetting_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
+# Poll answer IDs mapped to their index in the vote counts, and the labels used when
+# reporting the counts
+_ANSWER_INDEX = {"yes": 0, "no": 1, "blank": 2}
+_ANSWER_LABELS = ("Yes", "No", "Blank")
+
+# Room event filter used when gathering votes, so that only poll events are sent back.
+# Encrypted events have to be included too, as the server can't see their real type;
+# nio decrypts them before we look at them.
+_VOTE_MESSAGE_FILTER = {
+    "types": [
+        "org.matrix.msc3381.poll.response",
+        "org.matrix.msc3381.poll.start",
+        "m.room.encrypted",
+    ],
+}
+
 
 class Timer:
     def __init__(
@@ -29,30 +45,19 @@ class Timer:
         self.config = config
 
     async def start_all_timers(self):
-        self.store.cursor.execute(
-            """
-            SELECT mxid, poll_event_id, voting_start_time, vote_ended
-            FROM vetting
-            WHERE voting_start_time IS NOT NULL
-            """
-        )
-
-        rows = self.store.cursor.fetchall()
+        rows = await asyncio.to_thread(self.store.get_pending_polls)
         for row in rows:
-            if row[3]:
-                continue
-
-            await self.wait_for_poll_end(
-                mxid=row[0], poll_event_id=row[1], start_time=row[2]
-            )
+            self.wait_for_poll_end(mxid=row[0], poll_event_id=row[1], start_time=row[2])
 
-    async def wait_for_poll_end(self, mxid: str, poll_event_id: str, start_time: int):
-        async def _task():
-            time_left = start_time + self.config.voting_time - time.time()
-            await asyncio.sleep(time_left)
-            await self._end_poll(mxid, poll_event_id)
+    def wait_for_poll_end(self, mxid: str, poll_event_id: str, start_time: int):
+        # Polls that should already have ended are ended right away
+        time_left = max(0.0, start_time + self.config.voting_time - time.time())
 
-        asyncio.create_task(_task())
+        # A timer handle is much lighter than a task sleeping for the whole poll
+        asyncio.get_running_loop().call_later(
+            time_left,
+            lambda: asyncio.create_task(self._end_poll(mxid, poll_event_id)),
+        )
 
     async def _end_poll(self, mxid: str, poll_event_id: str):
         logger.info("Ending poll for %s - %s", mxid, poll_event_id)
@@ -71,81 +76,93 @@ class Timer:
         )
 
         if isinstance(poll_resp, RoomSendError):
-            logger.error(poll_resp, stack_info=True)
+            logger.error("Failed to send poll end: %s", poll_resp)
             return
 
         # Gather votes
-        message_filter = {
-            # "types": ["org.matrix.msc3381.poll.response"], # this doesn't work for some reason :/
-            "rooms": [self.config.vetting_room_id],
-        }
-
-        vote_count = {
-            "yes": 0,
-            "no": 0,
-            "blank": 0,
-        }
+        # Index of the answer each user voted for, or None for a spoiled vote. Events
+        # are paged newest first, so the first response seen from a user is the one
+        # that counts.
+        votes = {}
+        add_vote = votes.setdefault
 
-        users_voted = set()
+        # Bind what the loops below use on every iteration to locals
+        room_id = self.config.vetting_room_id
+        room_messages = self.client.room_messages
+        poll_response_type = "org.matrix.msc3381.poll.response"
 
         # Loop until we find all events that could be related to the poll
-        # (max 20 times: 20 * 20 = up to 400 events deep or until we find the poll event)
+        # (max 20 times, or until we find the poll event). Homeservers may return fewer
+        # events than requested per page, but with only poll events being sent back
+        # most polls are found within the first page or two.
         start_token = ""
         for _ in range(0, 20):
             logger.debug("Requesting events")
-            message_resp = await self.client.room_messages(
-                room_id=self.config.vetting_room_id,
+            message_resp = await room_messages(
+                room_id=room_id,
                 start=start_token,
-                limit=20,
-                message_filter=message_filter,
+                limit=1000,
+                message_filter=_VOTE_MESSAGE_FILTER,
             )
 
             if isinstance(message_resp, RoomMessagesError):
-                logging.error(message_resp, stack_info=True)
+                logger.error("Failed to get poll responses: %s", message_resp)
                 text = "Unable to gather votes."
-                await send_text_to_room(self.client, self.config.vetting_room_id, text)
+                await send_text_to_room(self.client, room_id, text)
                 return
 
             # Resume next request where this ends
             start_token = message_resp.end
 
-            # Count votes
+            # Count votes, until reaching the poll start event. Anything before it
+            # can't be a response to the poll.
+            found_poll = False
             for event in message_resp.chunk:
+                if event.event_id == poll_event_id:
+                    found_poll = True
+                    break
+
                 # Only process poll response events
                 if not isinstance(event, UnknownEvent):
                     continue
-                if event.type != "org.matrix.msc3381.poll.response":
+                if event.type != poll_response_type:
+                    continue
+                content = event.source.get("content") or {}
+
+                # Check if this response is for the correct poll
+                relates_to = content.get("m.relates_to") or {}
+                if relates_to.get("event_id") != poll_event_id:
                     continue
-                content = event.source.get("content")
-                try:
-                    # Check if this response is for the correct poll
-                    related_event_id = content["m.relates_to"]["event_id"]
-                    if related_event_id != poll_event_id:
-                        continue
-
-                    # Add vote to count
-                    answer = content["org.matrix.msc3381.poll.response"]["answers"][0]
-
-                    # Only count the last poll response event
-                    if event.sender in users_voted:
-                        continue
-                    users_voted.add(event.sender)
-                    vote_count[answer] += 1
-                except KeyError:
-                    pass
-
-            # Check if we found the initial poll event
-            if any([event.event_id == poll_event_id for event in message_resp.chunk]):
+
+                # A response without a valid answer spoils the vote, but it still
+                # replaces the sender's earlier responses
+                response = content.get("org.matrix.msc3381.poll.response") or {}
+                answers = response.get("answers")
+                answer = answers[0] if isinstance(answers, list) and answers else None
+                answer_index = (
+                    _ANSWER_INDEX.get(answer) if isinstance(answer, str) else None
+                )
+
+                # Only count the last poll response event
+                add_vote(event.sender, answer_index)
+
+            if found_poll:
                 break
 
+        # Yes, no and blank votes
+        vote_count = [0, 0, 0]
+        for answer_index in votes.values():
+            if answer_index is not None:
+                vote_count[answer_index] += 1
+
         votes_responses = "".join(
-            [f"\n{answer.title()}: {count};" for answer, count in vote_count.items()]
+            f"\n{label}: {count};" for label, count in zip(_ANSWER_LABELS, vote_count)
         )
 
         # Make the decision by checking requirements
         decision = (
-            vote_count["yes"] >= self.config.min_yes_votes
-            and vote_count["no"] <= self.config.max_no_votes
+            vote_count[0] >= self.config.min_yes_votes
+            and vote_count[1] <= self.config.max_no_votes
         )
 
         decision_text = (
@@ -163,7 +180,7 @@ class Timer:
         )
 
         if not isinstance(decision_resp, RoomSendResponse):
-            logger.error(decision_resp)
+            logger.error("Failed to send vote decision: %s", decision_resp)
             return
 
         if decision:
@@ -175,10 +192,4 @@ class Timer:
             )
 
         # Finally - update database
-        self.store.cursor.execute(
-            "UPDATE vetting SET vote_ended = 1, decision_event_id = ? WHERE mxid = ?",
-            (
-                decision_resp.event_id,
-                mxid,
-            ),
-        )
+        await asyncio.to_thread(self.store.set_vote_ended, mxid, decision_resp.event_id)